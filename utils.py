@@ -7,8 +7,10 @@ Model and Linear Discriminant Analysis so that they follow
 the MOCA interface
 """
 import re
+import csv
+import copy
 import numpy as np
-import os
+import pandas as pd
 
 
 from moca import classifiers as cls
@@ -18,14 +20,54 @@ from moca import stats
 from sklearn.mixture import GaussianMixture
 from sklearn import metrics
 
+from scipy.stats import rankdata
+
+from joblib import Parallel, delayed
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 
 UMOCA_MAX_ITER=20000
 UMOCA_TOL=1e-4
 
 
+if njit is not None:
+
+    @njit(cache=True, parallel=True)
+    def _gmm_score(a, b, data, out):
+        """Diagonal Gmm discriminant, one thread per sample."""
+        for i in prange(data.shape[1]):
+            s = 0.0
+            for j in range(data.shape[0]):
+                s += a[j] * data[j, i] * data[j, i] + b[j] * data[j, i]
+            out[i] = s
+
+
 def compute_auc(cl, test_data, test_labels):
-    return metrics.roc_auc_score(test_labels,
-                                 cl.get_scores(test_data))
+    """AUC by the Mann-Whitney U statistic of the sample scores.
+
+    Equal to metrics.roc_auc_score, without constructing the
+    ROC curve.
+    """
+    positives = test_labels == 1
+
+    if (n_pos := np.count_nonzero(positives)) in (0, test_labels.size):
+        raise ValueError("AUC requires samples of both classes")
+
+    n_neg = test_labels.size - n_pos
+
+    scores = cl.get_scores(test_data)
+
+    # rankdata propagates NaN, where roc_auc_score raised
+    if np.any(np.isnan(scores)):
+        raise ValueError("Input contains NaN")
+
+    ranks = rankdata(scores)
+
+    return (ranks[positives].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
 
 def compute_f1_score(cl, test_data, test_labels):
     return metrics.f1_score(test_labels,
@@ -36,12 +78,28 @@ def compute_ba(cl, test_data, test_labels):
                                            cl.get_inference(test_data))
 
 class Gmm(cls.MocaABC):
+    """Two component Gaussian mixture model classifier.
+
+    Args:
+        covariance_type: (str)
+            one of "spherical", "tied", "diag", or "full",
+            see sklearn.mixture.GaussianMixture
+        use_numba: (bool)
+            score samples with a numba compiled kernel, requires
+            numba and is only applied to "diag" and "spherical"
+            covariance, default False
+    """
 
     is_supervised = False
 
-    def __init__(self, covariance_type):
+    def __init__(self, covariance_type, use_numba=False):
         super().__init__()
+
+        if use_numba and njit is None:
+            raise ImportError("use_numba requires the numba package")
+
         self._cov_type = covariance_type
+        self._use_numba = use_numba
         self._gmm = GaussianMixture(n_components=2,
                                     covariance_type=covariance_type)
 
@@ -69,58 +127,84 @@ class Gmm(cls.MocaABC):
         delta = (self._gmm.means_[self._negative_idx, :]
                  - self._gmm.means_[self._pos_idx, :])
 
-        delta = np.where(delta > 0, 1, 0)
-
         # if more than half the number of classifiers
         # have a positive delta, then switch the indexes
-        if self.M/2 < np.sum(delta):
+        if self.M/2 < np.count_nonzero(delta > 0):
             self._pos_idx = 0
             self._negative_idx = 1
             self.prevalence = self._gmm.weights_[self._pos_idx]
 
-    def _component_cov(self, comp_idx):
+        self._scoring_coefs()
+
+    def _component_precision(self, comp_idx):
+        """Precision of a component, as fit by GaussianMixture.
+
+        Diagonal and spherical precisions are returned as the
+        (m classifiers,) vector of diagonal entries, full and tied
+        as (m classifiers, m classifiers) matrices.
+        """
         if self._cov_type == "spherical":
 
-            return self._gmm.covariances_[comp_idx] * np.eye(self.M)
+            return np.full(self.M, self._gmm.precisions_[comp_idx])
 
         elif self._cov_type == "tied":
             
-            return self._gmm.covariances_
+            return self._gmm.precisions_
 
         elif self._cov_type == "diag":
 
-            return np.diag(self._gmm.covariances_[comp_idx, :])
+            return self._gmm.precisions_[comp_idx, :]
 
         elif self._cov_type == "full":
             
-            return self._gmm.covariances_[comp_idx, :, :]
+            return self._gmm.precisions_[comp_idx, :, :]
 
         raise ValueError("Specified covariance matrix typei"
                          f" {self._cov_type} is not an option")
 
+    def _scoring_coefs(self):
+        """Quadratic and linear coefficients of the discriminant.
+
+        The score of sample x is x^T A x + b^T x, where
+
+            A = P_pos - P_negative
+            b = 2 (mu_negative P_negative - mu_pos P_pos)
+
+        and P are the component precision matrices.  For diagonal
+        and spherical covariance A is diagonal, and is stored as
+        the (m classifiers,) vector of its diagonal entries.
+        """
+        pmat_pos = self._component_precision(self._pos_idx)
+        pmat_negative = self._component_precision(self._negative_idx)
+
+        mu_pos = self._gmm.means_[self._pos_idx, :]
+        mu_negative = self._gmm.means_[self._negative_idx, :]
+
+        self._a = pmat_pos - pmat_negative
+
+        if self._a.ndim == 1:
+            self._b = 2 * (mu_negative * pmat_negative - mu_pos * pmat_pos)
+        else:
+            self._b = 2 * (mu_negative @ pmat_negative - mu_pos @ pmat_pos)
+
     def get_scores(self, data):
         if not stats.is_rank(data):
             raise ValueError
 
-        s = np.zeros(data.shape[1])
-        # loop over samples
-        for i in range(data.shape[1]):
-
-            # precision matrices
-            pmat_pos= np.linalg.inv(self._component_cov(self._pos_idx))
-            pmat_negative = np.linalg.inv(self._component_cov(self._negative_idx))
+        if self._a.ndim == 1 and self._use_numba:
+            s = np.empty(data.shape[1])
+            _gmm_score(self._a, self._b, np.asarray(data, dtype=np.float64), s)
+            return s
 
+        # x^T A x for all samples in one einsum reduction,
+        # without materializing data**2
+        if self._a.ndim == 1:
+            return np.einsum("j,ji,ji->i", self._a, data, data) + self._b @ data
 
-            s[i] += (data[:, i] @ (pmat_pos - pmat_negative) @ data[:, i]
-                     + 2 * (self._gmm.means_[self._negative_idx,:] @ pmat_negative
-                            - self._gmm.means_[self._pos_idx, :] @ pmat_pos) 
-                     @ data[:, i])
+        return np.einsum("ji,ji->i", self._a @ data, data) + self._b @ data
 
-        return s
 
-
-def read_data(fname, method_regex,
-              datum_regex=r"^[+-]?[0-9]*\.?[0-9]*E?e?[+-]?[0-9]*$"):
+def read_data(fname, method_regex):
     """Load data under the assumed specification.
 
     Data specification:
@@ -149,95 +233,77 @@ def read_data(fname, method_regex,
             regular expression for identifying methods
 
     Return:
-        X: ((n samples, m classifiers) np.ndarray)
-            Sample scores by each base classifier
+        X: ((m classifiers, n samples) np.ndarray)
+            Sample scores by each base classifier, C-contiguous,
+            the layout expected by moca
         y: ((n samples,) np.ndarray)
-            sample class labels, 0 and 1, representing the
-            negative and positive class labels, respectively. 
+            sample class labels, 0 and 1 of dtype np.uint8,
+            representing the negative and positive class labels,
+            respectively. 
         cls_names: (list)
             classifier team names in order of data matrix
     """
     delim = ","
 
 
-    with open(fname, "r") as fid:
+    with open(fname, "r", newline="") as fid:
 
-        # Decompose header and get the number of samples
+        # Decompose header
         cls_names = []
         score_col_idx = []
         label_col_idx = None
 
-        for i, tline in enumerate(fid):
-
-            if i == 0:
+        # csv parses quoted fields as pandas does, so that column
+        # positions agree with the body parse below
+        if (tline := next(csv.reader(fid, delimiter=delim), None)) is None:
+            raise ValueError("Could not decompose header")
 
-                tline = tline.strip().split(delim)
+        for j, field in enumerate(tline):
 
-                for j, field in enumerate(tline):
-
-                    if re.match("^class$", field):
-                        label_col_idx = j
-                        continue
-
-                    if field in cls_names:
-                        raise ValueError("Duplicate team names")
-
-                    if (re.match(method_regex, field)
-                        is not None):
-                        cls_names.append(field)
-                        score_col_idx.append(j)
-
-                if ((m_cls := len(score_col_idx)) == 0
-                        or label_col_idx is None):
-                    raise ValueError("Could not decompose header")
-
-        n_samples = i
-
-        X = np.zeros(shape=(m_cls, n_samples))
-        y = np.zeros(n_samples)
-
-        # return file object to the beginning of file
-        fid.seek(0, os.SEEK_SET)
-
-
-        sample_idx = 0
-        for i, tline in enumerate(fid):
-            
-            if i == 0:
+            if re.match("^class$", field):
+                label_col_idx = j
                 continue
 
-            tline = tline.strip().split(delim)
-
-            if (re.match(datum_regex, tline[label_col_idx])
-                is None):
-                raise ValueError(("Incorrect sample label"
-                                 f" {tline[label_col_idx]}"))
-
-            y[sample_idx] = np.float16(tline[label_col_idx])
-
-
-            for j, cls_idx in enumerate(score_col_idx):
-                val = tline[cls_idx]
-
-                if val == "":
-                    X[j, sample_idx] = np.nan
-                elif re.match(datum_regex, val) is not None:
-                    X[j, sample_idx] = np.float64(val)
-                elif (re.match("^NaN$", val) is not None
-                      or val == ""):
-                    X[j, sample_idx] = np.nan
-                else:
-                    raise ValueError(("Error while parsing"
-                                      f" file at line {i}"
-                                      f"\r {','.join(tline)}"))
-
-            sample_idx += 1
-
-    return X, y, cls_names
+            if field in cls_names:
+                raise ValueError("Duplicate team names")
 
+            if (re.match(method_regex, field)
+                is not None):
+                cls_names.append(field)
+                score_col_idx.append(j)
 
-def read_cross_validation_file(fname, row_idx_regex="k_folds",
-              datum_regex=r"^[+-]?[0-9]*\.?[0-9]*E?e?[+-]?[0-9]*$"):
+        if (len(score_col_idx) == 0
+                or label_col_idx is None):
+            raise ValueError("Could not decompose header")
+
+    # columns are keyed by their position in the file, so that
+    # the data matrix follows the order of cls_names
+    df = pd.read_csv(fname,
+                     sep=delim,
+                     header=None,
+                     skiprows=1,
+                     usecols=score_col_idx + [label_col_idx],
+                     dtype=np.float64,
+                     na_values=["", "NaN"],
+                     keep_default_na=False,
+                     skip_blank_lines=False,
+                     engine="c",
+                     float_precision="round_trip")
+
+    X = df[score_col_idx].to_numpy().T
+    y = df[label_col_idx].to_numpy()
+
+    # blank lines are kept as rows, so that row i is file line
+    # i + 2.  Missing labels, and blank lines, are NaN and so
+    # neither 0 nor 1
+    if (bad_idx := np.flatnonzero((y != 0) & (y != 1))).size > 0:
+        raise ValueError(("Incorrect sample label"
+                          f" {y[bad_idx[0]]} at line {bad_idx[0] + 2}"))
+
+    return X, y.astype(np.uint8), cls_names
+
+
+def read_cross_validation_file(fname, row_idx_regex="k_folds"):
     """Load data under the assumed specification.
 
     Stat file specification:
@@ -277,73 +343,81 @@ def read_cross_validation_file(fname, row_idx_regex="k_folds",
     """
     delim = ","
 
+    with open(fname, "r", newline="") as fid:
+        header = next(csv.reader(fid, delimiter=delim), None)
 
-    with open(fname, "r") as fid:
+    if header is None:
+        raise ValueError("Could not decompose header")
 
-        # Decompose header and get the number of samples
-        cls_names = []
-        score_col_idx = []
+    # Decompose header
+    cls_names = []
+    score_col_idx = []
 
-        for i, tline in enumerate(fid):
+    for j, field in enumerate(header):
 
-            if i > 0:
-                continue
+        if field in cls_names:
+            raise ValueError("Duplicate team names")
 
-            tline = tline.strip().split(delim)
+        if re.match(row_idx_regex, field) is not None:
+            continue
 
-            for j, field in enumerate(tline):
+        cls_names.append(field)
+        score_col_idx.append(j)
 
-                if field in cls_names:
-                    raise ValueError("Duplicate team names")
 
-                if re.match(row_idx_regex, field) is not None:
-                    continue
+    if len(score_col_idx) == 0:
+        raise ValueError("Could not decompose header")
 
-                cls_names.append(field)
-                score_col_idx.append(j)
+    # str(np.nan) is written as "nan" by statistical_analyses.py
+    df = pd.read_csv(fname,
+                     sep=delim,
+                     header=None,
+                     skiprows=1,
+                     usecols=score_col_idx,
+                     dtype=np.float64,
+                     na_values=["", "NaN", "nan"],
+                     keep_default_na=False,
+                     engine="c",
+                     float_precision="round_trip")
 
+    X = df[score_col_idx].to_numpy()
 
-            if (m_cls := len(score_col_idx)) == 0:
-                raise ValueError("Could not decompose header")
+    return X, cls_names
 
-        k_folds = i
 
-        X = np.zeros(shape=(k_folds, m_cls))
+def _fold_copies(cl, n):
+    """Make n copies of cl, one per fold, with independent rngs.
 
-        # return file object to the beginning of file
-        fid.seek(0, os.SEEK_SET)
+    A plain deepcopy would freeze any np.random.Generator held by
+    cl, so that every fold drew identical values.  Instead, each
+    copy gets a child stream spawned from the classifier's own
+    generator, which also advances that generator for later calls.
+    """
+    copies = [copy.deepcopy(cl) for _ in range(n)]
 
+    for attr, val in getattr(cl, "__dict__", {}).items():
 
-        k_fold = 0
-        for i, tline in enumerate(fid):
-            
-            if i == 0:
-                continue
+        if isinstance(val, np.random.Generator):
 
-            tline = tline.strip().split(delim)
+            for cl_copy, child in zip(copies, val.spawn(n)):
+                setattr(cl_copy, attr, child)
 
-            for j, cls_idx in enumerate(score_col_idx):
-                val = tline[cls_idx]
+    return copies
 
-                if val == "":
-                    X[k_fold, j] = np.nan
-                elif re.match(datum_regex, val) is not None:
-                    X[k_fold, j] = np.float64(val)
-                elif (re.match("^NaN$", val) is not None
-                      or val == ""):
-                    X[k_fold, j] = np.nan
-                else:
-                    raise ValueError(("Error while parsing"
-                                      f" file at line {i}"
-                                      f"\r {','.join(tline)}"))
 
-            k_fold += 1
+def _fit_score(i, k, cl, train, test, metric_func):
+    """Fit classifier on train and evaluate metric_func on test."""
+    if cl.is_supervised:
+        cl.fit(train["data"], train["labels"])
+    else:
+        cl.fit(train["data"])
 
-    return X, cls_names
+    return i, k, metric_func(cl, test["data"], test["labels"])
 
 
 def performance_by_stratified_cv(data, labels, moca_cls,
-                                 metric_func, kfolds=5, seed=None):
+                                 metric_func, kfolds=5, seed=None,
+                                 n_jobs=-1):
     """Compute AUC by stratified cross-validation
     
     Args:
@@ -353,7 +427,12 @@ def performance_by_stratified_cv(data, labels, moca_cls,
             sample class labels, 0 and 1, representing the
             negative and positive class labels, respectively. 
         moca_cls: (list)
-            list of moca compatible classifier instances
+            list of moca compatible classifier instances, each
+            (classifier, fold) pair is fit on a copy, so that
+            the instances themselves are not fit.  A
+            np.random.Generator attribute of a classifier is
+            replaced in each copy by an independent child stream
+            spawned from it, see _fold_copies
         metric_func: (function)
            one of either:
                 - compute_auc,
@@ -364,6 +443,9 @@ def performance_by_stratified_cv(data, labels, moca_cls,
             default=5
         seed: (np.random.default_rng compatible seed)
             default None
+        n_jobs: (int)
+            number of (classifier, fold) pairs evaluated in
+            parallel, see joblib.Parallel, default -1 all cores
 
     Returns:
         performance: ((k folds, n classifiers) np.ndarray)
@@ -373,35 +455,35 @@ def performance_by_stratified_cv(data, labels, moca_cls,
     """
     rng = np.random.default_rng(seed=seed)
 
-    cl_labels = []
+    cl_labels = [cl.name for cl in moca_cls]
 
     performance = np.zeros(shape=(kfolds, len(moca_cls)))
 
-    for i, cl in enumerate(moca_cls):
-
-        cl_labels.append(cl.name)
-
-        cv_generator = cv.stratified_kfold(data, labels, kfolds, seed=rng)
+    # the same folds are used for every classifier, so that
+    # classifier performances are compared on identical splits
+    folds = list(cv.stratified_kfold(data, labels, kfolds, seed=rng))
 
-        k = 0
-        for train, test in cv_generator:
+    tasks = [(i, k, cl_copy, train, test)
+             for i, cl in enumerate(moca_cls)
+             for k, (cl_copy, (train, test))
+                in enumerate(zip(_fold_copies(cl, kfolds), folds))]
 
-            if cl.is_supervised:
-                cl.fit(train["data"], train["labels"])
-            else:
-                cl.fit(train["data"])
-
-            performance[k,i] = metric_func(cl, test["data"], test["labels"])
-
-            k += 1
+    results = Parallel(n_jobs=n_jobs, backend="loky")(
+                delayed(_fit_score)(*task, metric_func)
+                for task in tasks)
 
+    for i, k, value in results:
+        performance[k, i] = value
 
     return performance, cl_labels
     
 
 def cov2corr(c):
-    corr= np.zeros(shape=c.shape)
-    for i in range(corr.shape[0]):
-        for j in range(1, corr.shape[0]):
-            corr[i, j] = c[i,j] / np.sqrt(c[i, i] * c[j, j])
-    return corr + corr.T + np.eye(c.shape[0])
+    """Convert a covariance matrix into a correlation matrix.
+
+    Entries with a zero variance in either the row or column
+    classifier are set to 0.
+    """
+    d = np.sqrt(np.diag(c))
+    norm = d[:, None] * d[None, :]
+    return np.divide(c, norm, out=np.zeros(shape=c.shape), where=norm > 0)